@@ -26,12 +26,17 @@ How to order the data for this script:
 # importing modules
 
 from scipy.io import loadmat
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import os
+import re
+import sys
 from tqdm import tqdm
-import matplotlib.pyplot as plt
-import pdb
-from scipy.ndimage import gaussian_filter
+try:
+    from numba import njit # optional: JIT-compiles the event scan for very long recordings
+except ImportError:
+    njit = None
 
 
 # specifying important paths. The outpath is where we want to save the .txt files
@@ -49,114 +54,295 @@ features = ['Track']
 DECIMALS = 4 # what we will round our data to
 THRESHOLD_SPEED = 10 # in degrees per second
 THRESHOLD_DURATION = 0.5 # optional for now
-SMOOTHNESS = 2 # smoothness of the gaussian filter 
+SMOOTHNESS = 2 # smoothness of the gaussian filter
+
+
+def _build_gauss_1d(sigma):
+
+    ''' builds the same 1-D gaussian kernel that scipy.ndimage.gaussian_filter would
+    build on every call (same truncation at 4 sigma), so we only pay for it once '''
+
+    radius = int(4 * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+_GAUSS_K = _build_gauss_1d(SMOOTHNESS) # precomputed once at import time
+_GAUSS_RADIUS = len(_GAUSS_K) // 2
+
+
+if njit is not None:
+
+    @njit(cache=True)
+    def _detect_events(times, angles, d_angles, thr_speed, thr_duration):
+
+        ''' the event-detection state machine as one compiled pass over the signal.
+        the duration interlock makes this awkward to express in pure NumPy, but it's
+        a natural loop for numba. returns the three event columns, trimmed to size '''
+
+        n = len(times)
+        onsets = np.empty(n) # upper bound: there can't be more events than samples
+        durations = np.empty(n)
+        end_angles = np.empty(n)
+        count = 0
+        onset = times[0]
+        at_zero = abs(d_angles[0]) < thr_speed
+        for i in range(1, n - 1):
+            if abs(d_angles[i]) > thr_speed and at_zero and times[i] - onset > thr_duration:
+                onsets[count] = onset
+                durations[count] = times[i] - onset
+                end_angles[count] = angles[i - 1]
+                count += 1
+                onset = times[i]
+            at_zero = abs(d_angles[i]) < thr_speed
+        # the last sample always closes the final event
+        onsets[count] = onset
+        durations[count] = times[n - 1] - onset
+        end_angles[count] = angles[n - 2] if n > 1 else angles[0]
+        count += 1
+        return onsets[:count], durations[:count], end_angles[:count]
 
 
 #%%
 # defining functions
 
+@lru_cache(maxsize=None)
+def _listdir(folder):
+
+    ''' a cached version of os.listdir, so we don't re-scan the same folder
+    for every run/condition/trial '''
+
+    return os.listdir(folder)
+
+
+
+@lru_cache(maxsize=None)
+def _raw_mat_path(subject):
+
+    ''' resolves a subject's RawData.mat filename once, instead of re-listing the
+    preprocessed folder on every call '''
+
+    folder = subject+r'/data/preprocessed/' # folder where preprocessed data is
+    return folder + next(name for name in _listdir(folder) if name.endswith('RawData.mat'))
+
+
+
+@lru_cache(maxsize=8)
+def _load_raw(subject):
+
+    ''' loads the RawData.mat file for a subject exactly once and keeps it in memory;
+    before this the same .mat was parsed again for every (run, condition, trial) '''
+
+    path = _raw_mat_path(subject)
+    return loadmat(path), path
+
+
+
+def _h5_path(subject):
+
+    ''' where the converted HDF5 copy of a subject's RawData.mat lives '''
+
+    return subject + r'/data/preprocessed/RawData.h5'
+
+
+
+def convert_subject(subject):
+
+    ''' a one-off conversion of a subject's RawData.mat to an HDF5 file that keeps only
+    the time and angle columns of each Track array. loading those two columns back is
+    much faster than parsing the whole MATLAB struct every time.
+    run the script with --convert to do this for all subjects at once '''
+
+    import h5py # only needed for the one-off conversion, so imported lazily
+    File, _ = _load_raw(subject)
+    with h5py.File(_h5_path(subject), 'w') as h5:
+        for run in runs:
+            group = File[struct_name][run].item()
+            for condition in conditions:
+                if condition not in group.dtype.names: # not every condition exists in the struct
+                    continue
+                node = group[condition].item()
+                for key in ['concated'] + trials: # the concatenated track plus the single trials
+                    if key not in node.dtype.names:
+                        continue
+                    track = node[key].item()['Track'].item()
+                    h5.create_dataset(f'{run}/{condition}/{key}/track',
+                                      data=track[:, [0, 4]], # time and angle columns only
+                                      compression='gzip')
+
+
+
+def _get_track(subject, run, condition, trial=None):
+
+    ''' returns the time and angle columns of one Track array; trial=None means the
+    concatenated track of the whole condition. reads the converted HDF5 copy when
+    one exists, and otherwise navigates the cached MATLAB struct — so the nested
+    .item() chain lives in exactly one place '''
+
+    key = 'concated' if trial is None else trial
+    if os.path.exists(_h5_path(subject)): # the fast path: subject was converted with --convert
+        import h5py
+        with h5py.File(_h5_path(subject), 'r') as h5:
+            track = h5[f'{run}/{condition}/{key}/track'][:]
+        return track[:, 0], track[:, 1]
+    File, _ = _load_raw(subject) # otherwise fall back to the (cached) .mat
+    track = File[struct_name][run].item()[condition].item()[key].item()['Track'].item()
+    return track[:, 0], track[:, 4] # first and fifth columns: time and angle
+
+
+
 def get_active_data(subject, run, condition, start_time=0):
-    
-    ''' a function for accessing the time and angle (in "track") in the LONG and SHORT conditions 
+
+    ''' a function for accessing the time and angle (in "track") in the LONG and SHORT conditions
     (from the preprocessed data)'''
-    
-    times = []
-    angles = []
-    folder = subject+r'/data/preprocessed/' # folder where preprocessed data is
-    File = loadmat(folder + [name for name in os.listdir(folder) if name.endswith('RawData.mat')][0]) 
-    
-    # navigating to data
-    subfolder = File['RAW'][run].item()[condition].item()['concated'].item()['Track'].item()
-    times = subfolder[:, 0] # first column
-    angles = subfolder[:, 4]# fifth column
+
+    times, angles = _get_track(subject, run, condition)
     return np.array(times) + start_time, np.array(angles)
         
 
 
-def get_passive_data(subject, *args, start_time=0): # run and condition aren't 
+@lru_cache(maxsize=None)
+def _passive_files(subject):
+
+    ''' lists a subject's unzipped raw track files once, so we don't re-scan the
+    whole Zip folder for every passive trial '''
+
+    passive_folder = subject + r'/data/raw/Zip/'
+    return passive_folder, tuple(f for f in _listdir(passive_folder) if f.endswith('track.txt'))
+
+
+
+@lru_cache(maxsize=None)
+def _find_passive_file(subject, params):
+
+    ''' finds the raw track file matching one indices entry, e.g. ('training06', 'LONG', '5').
+    cached per (subject, params) so every lookup scans the file list at most once '''
+
+    folder, files = _passive_files(subject)
+    # one compiled pattern per params tuple (this function is cached per tuple);
+    # the lookaheads check that every parameter appears somewhere in the name,
+    # in one pass instead of one substring scan per parameter
+    pattern = re.compile(''.join(f'(?=.*{re.escape(p)})' for p in params))
+    for file in files:
+        if (pattern.search(file) and # for each parameter in
+            #the indices file, is it also there in the raw data file
+            params[-1] == file.split('_')[-2]): # is the last parameter
+            #(i.e. trial number) in the indices == the trial number in the name of the raw file?
+            return folder + file
+
+
+
+def get_passive_data(subject, *args, start_time=0): # run and condition aren't
 # used here so *args is used as a place holder
-    
+
     ''' a function for accessing the Time and Angle (i.e. Track) in PASSIVE condition
     (from the RAW data)'''
-    
-    active_folder = subject+r'/data/preprocessed/'
-    passive_folder = subject + r'/data/raw/Zip/'
-    indices_file = [file for file in os.listdir(indices_path) # the files for the indices for each participant
-                    if file.startswith(subject) 
-                    and file.endswith('index_passive.txt')][0]
-    parameters = parse_indices(indices_path+indices_file) # extracting the parameters
+
+    parameters = parse_indices(_indices_file(subject)) # extracting the parameters
     # from the indices file, e.g. training06_LONG_5. The parse indices and parse functions are defined below.
-    times = []
-    angles = []    
-    
+    t_chunks = [] # per-trial arrays, concatenated once at the end (cheaper than
+    a_chunks = [] # growing a python list element by element)
+
+
     for params in parameters: # a loop for getting the information for passive trials which used training data
         if params[0].startswith('training'): # if the passive cond comes from training data
-            for file in os.listdir(passive_folder):
-                if (all([(p in file) for p in params]) and # for each parameter in 
-                    #the indices file, is it also there in the raw data file
-                    params[-1] == file.split('_')[-2] and # is the last parameter 
-                    #(i.e. trial number) in the indices == the trial number in the name of the raw file?
-                    file.endswith('track.txt')): # and the end of the raw file name is track
-                    
-                    f = np.loadtxt(passive_folder+file)
-                    more_times = f[:, 0]# new times plus the last time from prev trial (will make time continue)
-                    more_angles = f[:, 4]
+            f = np.loadtxt(_find_passive_file(subject, tuple(params)), # O(1) after the first lookup
+                           usecols=(0, 4)) # only parse the time and angle columns, the rest is thrown away anyway
+            more_times = f[:, 0]# new times plus the last time from prev trial (will make time continue)
+            more_angles = f[:, 1]
         else: # if the passive cond comes from active data (LONG/ SHORT) in the actual fMRI runs, and not training
-            File = loadmat(active_folder + [name for name in os.listdir(active_folder) if name.endswith('RawData.mat')][0])  
-            subfolder = File[struct_name][params[0]].item()[params[1]].item()['trial'+params[2]].item()['Track'].item()
-            more_times = subfolder[:, 0]
-            more_angles = subfolder[:, 4]
+            more_times, more_angles = _get_track(subject, params[0], params[1],
+                                                 'trial'+params[2]) # same cached data as get_active_data
 
-        times.extend(more_times - more_times[0] + start_time) 
+        t_chunks.append(more_times - more_times[0] + start_time)
         # to make sure that the times of trials are in order, and are added to previous trial times
-        angles.extend(more_angles)   
-        start_time += more_times[-1] - more_times[0]            
-    return np.array(times), np.array(angles) 
+        a_chunks.append(more_angles)
+        start_time += more_times[-1] - more_times[0]
+    return np.concatenate(t_chunks), np.concatenate(a_chunks)
    
 
 
     
 def data_to_event(times, angles, condition, start_time=None, passive=False):
-   
-    ''' a function for taking times and angles and converts them into events 
-    with event name, onset, duration and angle '''
 
-    d_angles = gaussian_filter(np.gradient(np.abs(angles), times), SMOOTHNESS) # applying a gaussian filter to smoothen the data;
+    ''' a function for taking times and angles and converts them into events.
+    returns the condition name plus one array per column (onsets, durations,
+    angles), which keeps the data NumPy-friendly for rounding and writing '''
+
+    abs_angles = np.abs(angles)
+    dts = np.diff(times)
+    if np.allclose(dts, dts[0]): # the tracker usually samples uniformly, so a simple
+        # forward difference is enough and avoids the temporaries np.gradient allocates
+        raw_d = np.empty_like(abs_angles)
+        raw_d[1:] = np.diff(abs_angles) / dts[0]
+        raw_d[0] = raw_d[1]
+    else: # non-uniform sampling: fall back to the full central-difference gradient
+        raw_d = np.gradient(abs_angles, times)
+    # smoothing with the precomputed kernel; padding by reflection gives the same
+    # boundary handling as scipy.ndimage.gaussian_filter, without its N-D overhead
+    d_angles = np.convolve(np.pad(raw_d, _GAUSS_RADIUS, mode='symmetric'),
+                           _GAUSS_K, mode='valid') # applying a gaussian filter to smoothen the data;
     # we take the derivative of the angles to define an event with 
     # using absolute value of angles bec we don't care about the direction for now
     # with gradients < threshold, there's no movement of the joystick, which is a way to define events
     # the gaussian filter is to smoothen the signal and make sure the little twitches don't count as an event
-    container = []
+    if njit is not None: # with numba available, do the whole scan in one compiled pass
+        onsets, durations, end_angles = _detect_events(np.asarray(times, dtype=float),
+                                                       np.asarray(angles, dtype=float),
+                                                       d_angles,
+                                                       float(THRESHOLD_SPEED),
+                                                       float(THRESHOLD_DURATION))
+        return condition, np.round(onsets, DECIMALS), np.round(durations, DECIMALS), end_angles
+
+    # without numba: we find all the candidate
+    # event boundaries in one go: an event can only close where the speed crosses
+    # the threshold from below (the old "at_zero" logic). np does this in C for the
+    # whole signal at once, and only the few actual crossings are handled in Python
+    d_abs = np.abs(d_angles)
+    rising = np.flatnonzero((d_abs[1:] > THRESHOLD_SPEED) &
+                            (d_abs[:-1] < THRESHOLD_SPEED)) + 1 # indices where the speed crosses the threshold upwards
+    onsets = [] # one list per column instead of one list per event,
+    durations = [] # so the result can be handled as plain arrays
+    end_angles = []
     onset = times[0] # onset of event--> the first time point of the trial
-    prev_angle = angles[0]
-    at_zero =  abs(d_angles[0]) < THRESHOLD_SPEED # if the previous data point was below threshold
-    for i, (time, angle, d_angle) in enumerate(zip(times, angles, d_angles)):
-        duration = time - onset
-        if (abs(d_angle) > THRESHOLD_SPEED and # if the new event is greater than the threshold
-            duration>THRESHOLD_DURATION and 
-            at_zero) or i == len(times) -1: # and the previous data point was below threshold
-        
-            container.append([condition, # wrapping up the first event (which was already opened by the onset)
-                              round(onset, DECIMALS),
-                              round(duration, DECIMALS), 
-                              prev_angle])
-        
-            onset = time # create new event, by saying that the onset = current time
-           
-        at_zero = abs(d_angle) < THRESHOLD_SPEED
-        prev_angle = angle
-      
-    # some plots to make the visualisation of data easy (commented out for now)
-    #plt.figure()
-    #plt.plot(times, d_angles, markersize= 1, color='tab:blue')
-    #print(times)
-    
-    #for event in container:
-        #plt.axvline(event[1], color='k', alpha=0.4, linestyle='--')
-    #plt.xlim(0,30)
-    #if len(plt.get_fignums())>5:raise Exception
-    
-    return container
+    for i in rising:
+        if i == len(times) - 1: # the last sample is always wrapped up below
+            break
+        duration = times[i] - onset
+        if duration > THRESHOLD_DURATION: # crossings that come too early don't close the event
+            onsets.append(onset)
+            durations.append(duration)
+            end_angles.append(angles[i-1]) # the angle just before the joystick moved again
+            onset = times[i] # create new event, by saying that the onset = current time
+
+    # wrapping up the last event, which runs until the end of the trial
+    onsets.append(onset)
+    durations.append(times[-1] - onset)
+    end_angles.append(angles[-2] if len(angles) > 1 else angles[0])
+
+    #_debug_plot(times, d_angles, onsets) # uncomment to eyeball the detected events
+
+    # rounding whole columns at once, like the numba path above, instead of
+    # calling round() once per event
+    return (condition, np.round(np.array(onsets), DECIMALS),
+            np.round(np.array(durations), DECIMALS), np.array(end_angles))
+
+
+
+def _debug_plot(times, d_angles, onsets):
+
+    ''' some plots to make the visualisation of data easy. matplotlib is only
+    imported here, so the module stays cheap to import in worker processes '''
+
+    import matplotlib.pyplot as plt
+    plt.figure()
+    plt.plot(times, d_angles, markersize= 1, color='tab:blue')
+    print(times)
+
+    for onset in onsets:
+        plt.axvline(onset, color='k', alpha=0.4, linestyle='--')
+    plt.xlim(0,30)
+    if len(plt.get_fignums())>5:raise Exception
 
 
 
@@ -166,67 +352,111 @@ def append_to_txt(eventfile, subject, run, condition, start_time=0):
     ''' a function for adding events to the .txt file for each condition, subject and run'''
     
     # we use the previously defined functions to get the appropriate data
-    get_data = get_passive_data if condition == 'PASSIVE' else get_active_data 
-    events = data_to_event(*get_data(subject, run, condition, start_time=start_time), # this creates the list of our events
-                           condition)
-    efile = open(eventfile, 'a') # opening .txt file to write the list events in
-    for e in events:
-        efile.write(';'.join(map(str, e))) # convert our list of events into text
-        efile.write('\n') # new line 
-    return events[-1][1] + events[-1][2] # returning the last onsetb+ the last duration
+    get_data = get_passive_data if condition == 'PASSIVE' else get_active_data
+    name, onsets, durations, angles = data_to_event(*get_data(subject, run, condition, start_time=start_time),
+                                                    condition) # this creates the columns of our events
+    # let np.savetxt format the whole table at once (its formatter is C-backed),
+    # instead of building each row's string in Python
+    rows = np.column_stack([np.full(len(onsets), name, dtype=object), # the condition name as the first column
+                            onsets, durations, angles])
+    with open(eventfile, 'a') as efile: # opening .txt file to write the list events in
+        np.savetxt(efile, rows,
+                   fmt=['%s', f'%.{DECIMALS}f', f'%.{DECIMALS}f', '%.6g'],
+                   delimiter=';')
+    return onsets[-1] + durations[-1] # returning the last onset + the last duration
                                     
 
 
 
+@lru_cache(maxsize=None)
+def _indices_file(subject):
+
+    ''' resolves a subject's index_passive.txt path once, instead of re-listing
+    the Indices folder on every call '''
+
+    return indices_path + [file for file in _listdir(indices_path) # the files for the indices for each participant
+                           if file.startswith(subject)
+                           and file.endswith('index_passive.txt')][0]
+
+
+
+@lru_cache(maxsize=None)
 def parse_indices(file):
-    
-    ''' function for reading .txt files and converts them to indices '''
-    
-    raw_passives = []
-    f = open(file)
-    for line in f:
-        if line.startswith('#'): # to ignore the comments in the files
-            continue
-        raw_passives.extend(line.split()) # split the line according to spaces
-    return [raw.split('_') for raw in raw_passives]
+
+    ''' function for reading .txt files and converts them to indices.
+    cached, since the same file used to be re-read once per run '''
+
+    text = open(file).read() # one read of the whole file
+    tokens = [raw
+              for line in text.splitlines() if not line.startswith('#') # to ignore the comments in the files
+              for raw in line.split()] # split the line according to spaces
+    if not tokens:
+        return []
+    return list(np.char.split(np.asarray(tokens), '_')) # one vectorized '_'-split over all tokens
+
+
 
 
+@lru_cache(maxsize=None)
+def _load_pulseinfo():
+
+    ''' loads the PULSEINFO struct from index_pulses.mat exactly once; every
+    (subject, run) used to re-list the Indices folder and re-parse the same file '''
+
+    folder = r'Indices/'
+    path = folder + [name for name in _listdir(folder) if name.endswith('index_pulses.mat')][0]
+    # the 0 makes sure we get the actual file within the list not the list itself
+    return loadmat(path)['PULSEINFO']
+
 
 
 def get_ordered_conditions(subject, run):
-    
-    ''' function for ordering the data according to the index_pulses.mat files. 
+
+    ''' function for ordering the data according to the index_pulses.mat files.
     note that the order is identified by the numbers of each condition (lowest = first and vice versa'''
 
-    folder = r'Indices/'
-    f = loadmat(folder + [name for name in os.listdir(folder) if name.endswith('index_pulses.mat')][0]) 
-    # loadig the file; the 0 makes sure we get the actual file within the list not the list itself
-    
-    group = f['PULSEINFO'][run].item()
+    group = _load_pulseinfo()[run].item()
     
     return sorted(conditions, key=lambda x: group[x][0][0][0][0]) # lambda is an anon function that allows one expression only
 
 
+def process_subject_run(subject, run):
+
+    ''' builds the complete event table for one (subject, run). every such pair is
+    independent of the others, which lets us farm them out to worker processes '''
+
+    start_time = 0
+    outputfile = outpath + f'eventTable_run{run[-1]}_{subject}.txt'
+    open(outputfile, 'w') # delete the old file and make a new one (so that we wouldn't add to it everytime we run the code)
+    ordcond = get_ordered_conditions(subject, run)
+    for condition in ordcond:
+
+        start_time = append_to_txt(outputfile,
+                                   subject,
+                                   run,
+                                   condition,
+                                   start_time=start_time) +20.
+
+
 #%%
 # main script: calling all the functions we defined
 
 if __name__ == '__main__': # to be able to use the same functions in other scripts through importing them
 
-    for subject in tqdm(os.listdir()):
-        if subject[0] in ['P', 'S'] and subject[-1].isdigit() and subject != 'S09': # choosing subject folders
-            print(subject)
-            for run in runs:            
-                start_time = 0
-                outputfile = outpath + f'eventTable_run{run[-1]}_{subject}.txt'
-                open(outputfile, 'w') # delete the old file and make a new one (so that we wouldn't add to it everytime we run the code)
-                ordcond = get_ordered_conditions(subject, run) 
-                for condition in ordcond:
-                    
-                    start_time = append_to_txt(outputfile,
-                                               subject,
-                                               run,
-                                               condition,
-                                               start_time=start_time) +20.
-               
+    subjects = [subject for subject in os.listdir() # choosing subject folders
+                if subject[0] in ['P', 'S'] and subject[-1].isdigit() and subject != 'S09']
+
+    if '--convert' in sys.argv: # one-off: dump every subject's RawData.mat to HDF5 and stop
+        for subject in tqdm(subjects):
+            convert_subject(subject)
+        sys.exit()
+
+    # each (subject, run) pair runs in its own worker process; the lru_caches are
+    # per process, so every worker loads each of its subjects' files just once
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        futures = [pool.submit(process_subject_run, subject, run)
+                   for subject in subjects for run in runs]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result() # re-raises any error that happened in a worker
 
 